@@ -1,14 +1,28 @@
 import os
 import matplotlib.pyplot as plt
 import numpy as np
-from data_loader import load_districts
-from sentinel_client import find_images, sort_images, get_band, crop_data
-from indices import calculate_ndvi, calculate_ndbi, normalize
+from data_loader import load_districts, add_keys
+from histograms import index_histogram, update_table
+from classify import get_classifier
+from sentinel_client import find_images, sort_images, screen_tiles, target_grid, get_band, crop_data
+from indices import (
+    calculate_ndvi, calculate_ndbi, normalize,
+    quantize_index, dequantize_index, pack_mask, unpack_mask
+)
 
-def do_processing(d_name, shp_path):
+def do_processing(d_name, shp_path, screening=None, compact=False, classifier=None):
     data = load_districts(shp_path)
-    
-    d = data[data['d_name'] == d_name]
+    if data is None:
+        return None
+    data = add_keys(data)
+
+    # d_name is a district key, or a plain name used in one state only
+    d = data[data['d_key'] == d_name]
+    if d.empty:
+        d = data[data['d_name'] == d_name]
+        if d['d_key'].nunique() > 1:
+            print("several districts are called", d_name + ":", sorted(set(d['d_key'])))
+            return None
     if d.empty:
         print("district not found")
         return None
@@ -25,29 +39,37 @@ def do_processing(d_name, shp_path):
         return None
         
     tiles = sort_images(items)
+
+    area = d.to_crs("EPSG:4326").geometry.unary_union
+    tiles, skipped = screen_tiles(tiles, area, **(screening or {}))
+    if len(tiles) == 0:
+        print("no usable tiles")
+        return None
     
     s = 0.2
+    # float32 is plenty for indices that end up as int16 anyway
+    dtype = np.float32 if compact else float
+
+    def drop_failed(t):
+        bad = {x['id'] for x in skipped}
+        return [i for i in t if i.id not in bad]
+    
+    # one grid over the district for every band, so no merge or resize later
+    grid = target_grid(tiles, "B04", s=s, bounds=bbox)
     
     print("getting bands...")
-    red, prof = get_band(tiles, "B04", s=s)
-    
-    nir, _ = get_band(tiles, "B08", s=s)
-    swir, _ = get_band(tiles, "B11", s=s)
-    
-    target = red.shape
-    print("shape is:", target)
-    
-    def fix_size(arr, t, n):
-        if arr.shape != t:
-            print("resizing", n)
-            from scipy.ndimage import zoom
-            z1 = t[0] / arr.shape[0]
-            z2 = t[1] / arr.shape[1]
-            return zoom(arr, (z1, z2), order=0)
-        return arr
-
-    nir = fix_size(nir, target, "NIR")
-    swir = fix_size(swir, target, "SWIR")
+    red, prof = get_band(tiles, "B04", s=s, skipped=skipped, grid=grid)
+    tiles = drop_failed(tiles)
+    
+    nir, _ = get_band(tiles, "B08", s=s, skipped=skipped, grid=grid)
+    tiles = drop_failed(tiles)
+    swir, _ = get_band(tiles, "B11", s=s, skipped=skipped, grid=grid)
+    if red is None or nir is None or swir is None:
+        print("could not read bands")
+        return None
+    prof['skipped_tiles'] = skipped
+    
+    print("shape is:", red.shape)
     
     print("clipping data...")
     crs = prof['crs']
@@ -55,23 +77,19 @@ def do_processing(d_name, shp_path):
     geoms = d_proj.geometry.values
     
     trans = prof['transform']
-    red, out_trans = crop_data(red, trans, geoms, crop=True)
+    red, out_trans = crop_data(red, trans, geoms, crop=True, dtype=dtype)
     prof['transform'] = out_trans
-    
-    new_shape = red.shape
-    print("new shape:", new_shape)
+    prof['height'], prof['width'] = red.shape
+    print("new shape:", red.shape)
 
-    nir, _ = crop_data(nir, trans, geoms, crop=True)
-    swir, _ = crop_data(swir, trans, geoms, crop=True)
-    
-    nir = fix_size(nir, new_shape, "NIR Masked")
-    swir = fix_size(swir, new_shape, "SWIR Masked")
+    nir, _ = crop_data(nir, trans, geoms, crop=True, dtype=dtype)
+    swir, _ = crop_data(swir, trans, geoms, crop=True, dtype=dtype)
     
     mask = (red > 0) & (nir > 0) & (~np.isnan(red))
     
-    red = red.astype(float)
-    nir = nir.astype(float)
-    swir = swir.astype(float)
+    red = red.astype(dtype)
+    nir = nir.astype(dtype)
+    swir = swir.astype(dtype)
     
     red[~mask] = np.nan
     nir[~mask] = np.nan
@@ -81,16 +99,33 @@ def do_processing(d_name, shp_path):
     ndvi = calculate_ndvi(red, nir)
     ndbi = calculate_ndbi(swir, nir)
     
-    slums = (ndbi > 0.05) & (ndvi < 0.3)
+    # fixed NDVI/NDBI rule unless a trained model is given
+    slums = get_classifier(classifier).predict(red, nir, swir, ndvi, ndbi)
+
+    if compact:
+        prof['compact'] = True
+        ndvi, ndbi, slums = quantize_index(ndvi), quantize_index(ndbi), pack_mask(slums)
+
+    prof['hist'] = {"ndvi": index_histogram(ndvi), "ndbi": index_histogram(ndbi)}
     
     return ndvi, ndbi, slums, prof
 
-def run_main(name, path, out="output"):
-    res = do_processing(name, path)
+def unpack_result(res):
+    # float32 indices and a bool mask, whether or not the scan was compact
+    ndvi, ndbi, slums, prof = res
+    if not prof.get('compact'):
+        return res
+    return dequantize_index(ndvi), dequantize_index(ndbi), unpack_mask(slums, prof['width']), prof
+
+def run_main(name, path, out="output", compact=False, hist_path=None, classifier=None):
+    res = do_processing(name, path, compact=compact, classifier=classifier)
     if res is None:
         return
         
-    ndvi, ndbi, slums, prof = res
+    ndvi, ndbi, slums, prof = unpack_result(res)
+
+    if hist_path:
+        update_table(hist_path, {name: prof['hist']})
     
     print("stats for ndvi:", np.nanmean(ndvi))
     print("stats for ndbi:", np.nanmean(ndbi))
@@ -123,7 +158,10 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("--district", type=str, default="Mahesana")
     p.add_argument("--shapefile", type=str, default="data/district.shp")
+    p.add_argument("--compact", action="store_true", help="int16 indices and packed sprawl mask")
+    p.add_argument("--hist", type=str, default=None, help="district_hist.npz to update")
+    p.add_argument("--model", type=str, default=None, help="joblib sprawl classifier")
     
     a = p.parse_args()
     
-    run_main(a.district, a.shapefile)
+    run_main(a.district, a.shapefile, compact=a.compact, hist_path=a.hist, classifier=a.model)
@@ -0,0 +1,376 @@
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from analysis import do_processing, unpack_result
+from data_loader import load_district_table, load_simplified
+from histograms import hist_path_for, load_table, QUANTILES
+from reporting import generate_pdf, district_insights
+from similarity import load_index, file_stamp
+
+# --- Constants & Paths (same layout as the dashboard) ---
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(PROJECT_ROOT, 'data')
+SHAPEFILE_PATH = os.path.normpath(os.path.join(PROJECT_ROOT, '..', 'district.shp'))
+STATS_PATH = os.path.join(PROJECT_ROOT, 'src', 'district_stats.csv')
+HIST_PATH = hist_path_for(STATS_PATH)
+GEOMETRY_CACHE_PATH = os.path.join(DATA_DIR, 'cache', 'district_simplified.gpkg')
+
+CACHE_BYTES = 64 << 20  # rendered response bodies kept in memory
+SCAN_WORKERS = 2       # scans running at the same time
+MAX_SCANS = 32         # finished scans kept in memory (running ones never evicted)
+RELOAD_EVERY = 1.0     # seconds between checks for changed data files
+
+class ResponseCache:
+    """
+    LRU of rendered (body, content_type) responses, bounded by body bytes,
+    since full-table bodies are much larger than single-district ones.
+
+    Keys include the data version, so a changed stats or histogram file
+    never serves old responses; they just age out.
+    """
+
+    def __init__(self, maxbytes=CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        n = len(value[0])
+        if n > self.maxbytes:
+            return
+        if key in self.items:
+            self.size -= len(self.items.pop(key)[0])
+        self.items[key] = value
+        self.size += n
+        while self.size > self.maxbytes:
+            _, old = self.items.popitem(last=False)
+            self.size -= len(old[0])
+
+class Store:
+    """
+    Stats table, histograms and district bounds, reloaded when the files
+    on disk change. Geometry bounds are only loaded for bbox queries.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked = 0
+        self.bounds = None
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload_due(self):
+        # cheap check on the event loop, true at most once per RELOAD_EVERY
+        now = time.monotonic()
+        if now - self.checked < RELOAD_EVERY:
+            return False
+        self.checked = now
+        return True
+
+    def reload(self):
+        """
+        Reloads the tables if the files changed. Stats the files, so it runs
+        in an executor thread, one reload at a time.
+        """
+        with self.lock:
+            self._reload()
+
+    def _reload(self):
+        version = (file_stamp(STATS_PATH), file_stamp(HIST_PATH))
+        if version == self.version:
+            return
+
+        df = load_district_table(SHAPEFILE_PATH, STATS_PATH)
+        if df is None:
+            raise ValueError(f"Could not load shapefile from {SHAPEFILE_PATH}")
+
+        # d_key ("Name (State)") is unique, d_name repeats across states
+        self.stats = df.set_index('d_key', drop=False)
+        self.hists = load_table(HIST_PATH)
+        self.version = version
+        print("api data version:", version)
+
+    def district_bounds(self):
+        if self.bounds is None:
+            gdf = load_simplified(SHAPEFILE_PATH, GEOMETRY_CACHE_PATH, tol=0.002)
+            b = gdf.to_crs("EPSG:4326").bounds
+            b['d_key'] = gdf['d_key'].values
+            self.bounds = b
+        return self.bounds
+
+    def resolve(self, name):
+        """
+        District key for `name`: a key as is, or a plain name used in one
+        state. 404 for unknown names, 409 with the candidate keys when the
+        name is used in several states.
+        """
+        if name in self.stats.index:
+            return name
+        hits = sorted(self.stats.loc[self.stats['d_name'] == name, 'd_key'])
+        if not hits:
+            raise web.HTTPNotFound(text="unknown district")
+        if len(hits) > 1:
+            body = {"error": "district name used in several states", "candidates": hits}
+            raise web.HTTPConflict(text=to_json(body).decode(), content_type="application/json")
+        return hits[0]
+
+    def rows(self, names):
+        # keys, or plain names, which match the district in every state using them
+        names = set(names)
+        df = self.stats
+        return records(df[df['d_key'].isin(names) | df['d_name'].isin(names)].sort_index())
+
+    def rows_in_bbox(self, bbox):
+        minx, miny, maxx, maxy = bbox
+        b = self.district_bounds()
+        hit = b[(b.minx <= maxx) & (b.maxx >= minx) & (b.miny <= maxy) & (b.maxy >= miny)]
+        return records(self.stats[self.stats['d_key'].isin(hit['d_key'])].sort_index())
+
+def records(df):
+    # NaN is not valid JSON
+    return df.astype(object).where(pd.notna(df), None).to_dict(orient="records")
+
+def to_json(obj):
+    return json.dumps(obj, default=lambda o: o.tolist() if isinstance(o, np.ndarray) else float(o)).encode()
+
+def respond(request, body, content_type="application/json"):
+    # strong ETag over the body, answers 304 when the client already has it
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers={"ETag": etag})
+
+    return web.Response(
+        body=body,
+        content_type=content_type,
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+def cached(handler):
+    """
+    Wraps a handler returning (body, content_type) with the response cache.
+    """
+    async def wrapper(request):
+        store = request.app['store']
+        # file stats and a possible table reload stay off the event loop,
+        # and only go to a thread when a check is due
+        if store.reload_due():
+            await asyncio.get_running_loop().run_in_executor(None, store.reload)
+
+        body = await request.read() if request.can_read_body else b""
+        key = (request.method, request.path, request.query_string, body, store.version)
+
+        hit = request.app['cache'].get(key)
+        if hit is None:
+            hit = await handler(request)
+            request.app['cache'].put(key, hit)
+
+        return respond(request, *hit)
+    return wrapper
+
+def parse_bbox(text):
+    try:
+        bbox = [float(x) for x in text.split(",")] if isinstance(text, str) else [float(x) for x in text]
+    except ValueError:
+        bbox = []
+    if len(bbox) != 4:
+        raise web.HTTPBadRequest(text="bbox must be minx,miny,maxx,maxy")
+    return bbox
+
+# --- Lookups ---
+@cached
+async def districts(request):
+    return to_json(sorted(request.app['store'].stats.index)), "application/json"
+
+@cached
+async def stats(request):
+    """
+    GET /stats?names=A,B or ?bbox=minx,miny,maxx,maxy
+    POST /stats {"names": [...]} or {"bbox": [...]}
+    """
+    store = request.app['store']
+    q = dict(request.query)
+    if request.method == "POST":
+        try:
+            q = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="invalid json")
+
+    if q.get("bbox"):
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, store.rows_in_bbox, parse_bbox(q["bbox"]))
+    elif q.get("names"):
+        names = q["names"].split(",") if isinstance(q["names"], str) else q["names"]
+        rows = store.rows(names)
+    else:
+        rows = records(store.stats)
+
+    return to_json(rows), "application/json"
+
+@cached
+async def district(request):
+    store = request.app['store']
+    key = store.resolve(request.match_info['name'])
+    return to_json(records(store.stats.loc[[key]])[0]), "application/json"
+
+@cached
+async def histogram(request):
+    store = request.app['store']
+    h = store.hists.get(store.resolve(request.match_info['name']))
+    if h is None:
+        raise web.HTTPNotFound(text="no histogram for this district")
+    h = dict(h, quantiles=list(QUANTILES))
+    return to_json(h), "application/json"
+
+@cached
+async def similar(request):
+    key = request.app['store'].resolve(request.match_info['name'])
+    try:
+        k = int(request.query.get("k", 5))
+    except ValueError:
+        raise web.HTTPBadRequest(text="k must be an integer")
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(None, load_index, STATS_PATH, HIST_PATH, SHAPEFILE_PATH)
+    res = index.query(key, k)
+    return to_json([{"d_key": n, "distance": d} for n, d in res]), "application/json"
+
+@cached
+async def report(request):
+    store = request.app['store']
+    key = store.resolve(request.match_info['name'])
+
+    row = store.stats.loc[key].to_dict()
+    loop = asyncio.get_running_loop()
+    pdf = await loop.run_in_executor(None, generate_pdf, key, row, district_insights(row))
+    return pdf, "application/pdf"
+
+# --- Scans ---
+def scan_summary(res):
+    ndvi, ndbi, slums, prof = unpack_result(res)
+    valid = ~np.isnan(ndvi)
+    return {
+        "mean_ndvi": float(np.nanmean(ndvi)) if valid.any() else None,
+        "mean_ndbi": float(np.nanmean(ndbi)) if valid.any() else None,
+        "sprawl_risk": float(100 * slums[valid].mean()) if valid.any() else None,
+        "shape": list(ndvi.shape),
+        "crs": str(prof['crs']),
+        "transform": list(prof['transform'])[:6],
+        "skipped_tiles": prof.get('skipped_tiles', []),
+    }
+
+async def start_scan(request):
+    try:
+        q = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="invalid json")
+
+    name = request.app['store'].resolve(q.get("district"))
+
+    scans = request.app['scans']
+    scan_id = uuid.uuid4().hex[:12]
+    scans[scan_id] = {"id": scan_id, "district": name, "status": "running"}
+
+    # drop the oldest finished scans, running ones are always kept
+    done = [k for k, v in scans.items() if v["status"] != "running"]
+    for k in done[:max(0, len(scans) - MAX_SCANS)]:
+        del scans[k]
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        scan = scans[scan_id]
+        try:
+            res = await loop.run_in_executor(
+                request.app['pool'], lambda: do_processing(name, SHAPEFILE_PATH, compact=True)
+            )
+        except Exception as e:
+            scan.update(status="failed", error=str(e))
+            return
+
+        if res is None:
+            scan.update(status="failed", error="no imagery")
+            return
+        scan.update(status="done", result=res, summary=scan_summary(res))
+
+    # the app is frozen once running, so the task set is pruned in place
+    tasks = request.app['tasks']
+    t = asyncio.create_task(run())
+    tasks.add(t)
+    t.add_done_callback(tasks.discard)
+
+    return web.json_response({"id": scan_id, "status": "running"}, status=202)
+
+def get_scan(request):
+    scan = request.app['scans'].get(request.match_info['id'])
+    if scan is None:
+        raise web.HTTPNotFound(text="unknown scan")
+    return scan
+
+async def scan_status(request):
+    scan = get_scan(request)
+    body = {k: v for k, v in scan.items() if k != "result"}
+    return respond(request, to_json(body))
+
+async def scan_layer(request):
+    # compact arrays as .npy: int16 indices (nodata -32768) or packed mask bits
+    scan = get_scan(request)
+    if scan["status"] != "done":
+        raise web.HTTPConflict(text="scan not finished")
+
+    layers = dict(zip(["ndvi", "ndbi", "sprawl"], scan["result"][:3]))
+    arr = layers.get(request.match_info['layer'])
+    if arr is None:
+        raise web.HTTPNotFound(text="unknown layer")
+
+    buf = io.BytesIO()
+    np.save(buf, arr)
+    return respond(request, buf.getvalue(), "application/octet-stream")
+
+def make_app():
+    app = web.Application()
+    app['store'] = Store()
+    app['cache'] = ResponseCache()
+    app['scans'] = OrderedDict()
+    app['tasks'] = set()
+    app['pool'] = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+
+    app.router.add_get("/districts", districts)
+    app.router.add_get("/districts/{name}", district)
+    app.router.add_get("/districts/{name}/histogram", histogram)
+    app.router.add_get("/districts/{name}/similar", similar)
+    app.router.add_get("/districts/{name}/report.pdf", report)
+    app.router.add_get("/stats", stats)
+    app.router.add_post("/stats", stats)
+    app.router.add_post("/scans", start_scan)
+    app.router.add_get("/scans/{id}", scan_status)
+    app.router.add_get("/scans/{id}/{layer}.npy", scan_layer)
+
+    return app
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--host", type=str, default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+
+    a = p.parse_args()
+
+    web.run_app(make_app(), host=a.host, port=a.port)
@@ -11,9 +11,12 @@ import sys
 
 # Setup Paths
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from analysis import do_processing
-from data_loader import load_districts
-from reporting import generate_pdf
+from analysis import do_processing, unpack_result
+from data_loader import load_district_table, load_simplified, STATE_COL
+from reporting import generate_pdf, district_insights, interpret_ndvi, interpret_ndbi, interpret_risk
+from tiles import start_tile_server, register_scan
+from histograms import QUANTILES, bin_edges, hist_path_for, load_table, update_table
+from similarity import load_index
 
 # --- Configuration ---
 st.set_page_config(
@@ -37,64 +40,70 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(PROJECT_ROOT, 'data')
 SHAPEFILE_PATH = os.path.normpath(os.path.join(PROJECT_ROOT, '..', 'district.shp'))
 STATS_PATH = os.path.join(PROJECT_ROOT, 'src', 'district_stats.csv')
+HIST_PATH = hist_path_for(STATS_PATH)
 
 # --- Data Loading ---
+GEOMETRY_CACHE_PATH = os.path.join(DATA_DIR, 'cache', 'district_simplified.gpkg')
+TILE_CACHE_DIR = os.path.join(DATA_DIR, 'cache', 'tiles')
+TILE_HOST = os.environ.get("URBANSIGHT_TILE_HOST", "127.0.0.1")
+TILE_PORT = int(os.environ.get("URBANSIGHT_TILE_PORT", 8765))
+# base URL the browser reaches the tile server on, e.g. a proxied route when deployed
+TILE_PUBLIC_URL = os.environ.get("URBANSIGHT_TILE_URL")
+
 @st.cache_data
-def get_data():
+def get_stats():
     try:
-        gdf = load_districts(SHAPEFILE_PATH)
-        if gdf is None:
+        df = load_district_table(SHAPEFILE_PATH, STATS_PATH)
+        if df is None:
             raise ValueError(f"Could not load shapefile from {SHAPEFILE_PATH}")
+        return df
+    except Exception as e:
+        st.error(f"Data Load Error: {e}")
+        return pd.DataFrame()
 
-        gdf['geometry'] = gdf['geometry'].simplify(0.002)
-        
-        if os.path.exists(STATS_PATH):
-            stats_df = pd.read_csv(STATS_PATH)
-            gdf = gdf.merge(stats_df, on="d_name", how="left")
-        else:
-            # Fallback defaults
-            gdf['mean_ndvi'] = 0.3
-            gdf['mean_ndbi'] = 0.05
-            gdf['sprawl_risk'] = 10.0
-            
+@st.cache_data
+def get_geometries():
+    # Only needed by the map, so it is loaded once the map is switched on
+    try:
+        gdf = load_simplified(SHAPEFILE_PATH, GEOMETRY_CACHE_PATH, tol=0.002)
+        if gdf is None:
+            raise ValueError(f"Could not load shapefile from {SHAPEFILE_PATH}")
         return gdf
     except Exception as e:
         st.error(f"Data Load Error: {e}")
         return gpd.GeoDataFrame()
 
+@st.cache_data
+def get_histograms():
+    try:
+        return load_table(HIST_PATH)
+    except Exception as e:
+        st.error(f"Histogram Load Error: {e}")
+        return {}
+
+@st.cache_resource
+def get_tile_server():
+    return start_tile_server(host=TILE_HOST, port=TILE_PORT, public_url=TILE_PUBLIC_URL)
+
 try:
-    gdf = get_data()
-    if gdf.empty:
+    stats_df = get_stats()
+    if stats_df.empty:
         st.error("No data available. Application cannot start.")
         st.stop()
-    district_list = sorted(gdf['d_name'].dropna().unique())
+    # districts are picked by key, "Name (State)", names repeat across states
+    district_list = sorted(stats_df['d_key'].dropna().unique())
 except Exception as e:
     st.error(f"Initialization Error: {e}")
     st.stop()
 
-# --- Helper Functions (Interpretation) ---
-def interpret_ndvi(val):
-    if val > 0.4: return "Very Green (Healthy)", "#30d158"
-    if val > 0.2: return "Moderate Greenery", "#ff9f0a"
-    return "Sparse Vegetation", "#ff453a"
-
-def interpret_ndbi(val):
-    if val > 0.1: return "High Urban Density", "#ff453a"
-    if val > -0.1: return "Moderate Built-up", "#ff9f0a"
-    return "Low Urbanization", "#30d158"
-
-def interpret_risk(val):
-    if val > 50: return "Critical Sprawl", "#ff453a"
-    if val > 20: return "Warning Level", "#ff9f0a"
-    return "Stable", "#30d158"
-
 # --- Sidebar Logic ---
 with st.sidebar:
     st.markdown('<div class="brand-text" style="font-size:1.5rem; font-weight:700; margin-bottom:20px;">UrbanSight.</div>', unsafe_allow_html=True)
     
     # District Selector
     if "selected_district" not in st.session_state:
-        st.session_state.selected_district = "Agra"
+        agra = stats_df.loc[stats_df['d_name'] == "Agra", 'd_key']
+        st.session_state.selected_district = agra.iloc[0] if len(agra) else district_list[0]
         
     selected_district = st.selectbox(
         "Target Sector", 
@@ -104,7 +113,7 @@ with st.sidebar:
     st.session_state.selected_district = selected_district
     
     # Stats for selection
-    d_stats = gdf[gdf['d_name'] == selected_district].iloc[0]
+    d_stats = stats_df[stats_df['d_key'] == selected_district].iloc[0]
     
     st.markdown("---")
     
@@ -142,12 +151,18 @@ with st.sidebar:
     if st.button("Run Satellite Scan"):
         with st.spinner("Acquiring Satellite Feed..."):
             try:
-                res = do_processing(selected_district, SHAPEFILE_PATH)
+                res = do_processing(selected_district, SHAPEFILE_PATH, compact=True)
                 if res is None:
                     st.warning("No satellite imagery found for this region.")
                     st.session_state.scan_result = None
+                    st.session_state.scan_layers = None
                 else:
                     st.session_state.scan_result = res
+                    get_tile_server()
+                    scan_id = f"{selected_district}-{pd.Timestamp.now():%Y%m%d%H%M%S}"
+                    st.session_state.scan_layers = register_scan(scan_id, *unpack_result(res), cache_dir=TILE_CACHE_DIR)
+                    update_table(HIST_PATH, {selected_district: res[3]['hist']})
+                    get_histograms.clear()
                     st.success("Scan Complete")
             except Exception as e:
                 st.error(f"Scan Failed: {e}")
@@ -170,60 +185,83 @@ with tab1:
     col_map, col_details = st.columns([3, 1])
     
     with col_map:
-        # Prepare Map Data
-        gdf = gdf.dropna(subset=['d_name']) # Drop rows without names
-        gdf['sprawl_risk'] = gdf['sprawl_risk'].fillna(0)
-        gdf['safety_score'] = 100 - gdf['sprawl_risk']
+        # every tab body runs on each rerun, so the map (outlines + choropleth)
+        # is only built once it is switched on
+        show_map = st.toggle("Show district map", key="show_map")
+        if show_map:
+            # Prepare Map Data
+            gdf = get_geometries()
+            gdf = gdf.dropna(subset=['d_name']) # Drop rows without names
+            gdf = gdf.merge(stats_df.drop(columns=['d_name', STATE_COL], errors='ignore'), on="d_key", how="left")
+            gdf['sprawl_risk'] = gdf['sprawl_risk'].fillna(0)
+            gdf['safety_score'] = 100 - gdf['sprawl_risk']
         
-        m = folium.Map(
-            location=[22.0, 79.0], 
-            zoom_start=4.5, 
-            min_zoom=4,
-            tiles="CartoDB dark_matter"
-        )
+            m = folium.Map(
+                location=[22.0, 79.0], 
+                zoom_start=4.5, 
+                min_zoom=4,
+                tiles="CartoDB dark_matter"
+            )
         
-        # Chloropleth
-        folium.Choropleth(
-            geo_data=gdf.__geo_interface__,
-            data=gdf,
-            columns=['d_name', 'safety_score'],
-            key_on="feature.properties.d_name",
-            fill_color='RdYlGn',
-            fill_opacity=0.4,
-            line_opacity=0.3,
-            legend_name="Ecological Safety Score",
-            highlight=True
-        ).add_to(m)
+            # Chloropleth
+            folium.Choropleth(
+                geo_data=gdf.__geo_interface__,
+                data=gdf,
+                columns=['d_key', 'safety_score'],
+                key_on="feature.properties.d_key",
+                fill_color='RdYlGn',
+                fill_opacity=0.4,
+                line_opacity=0.3,
+                legend_name="Ecological Safety Score",
+                highlight=True
+            ).add_to(m)
         
-        # Highlight Selected
-        sel_geom = gdf[gdf['d_name'] == selected_district]
-        if not sel_geom.empty:
+            # Highlight Selected
+            sel_geom = gdf[gdf['d_key'] == selected_district]
+            if not sel_geom.empty:
+                folium.GeoJson(
+                    sel_geom,
+                    style_function=lambda x: {'fillColor': 'transparent', 'color': '#2997ff', 'weight': 3}
+                ).add_to(m)
+                # Zoom to selected
+                b = sel_geom.total_bounds
+                m.fit_bounds([[b[1], b[0]], [b[3], b[2]]])
+
+            # Scan overlays, served as XYZ tiles from the local tile server
+            scan_layers = st.session_state.get("scan_layers")
+            if scan_layers:
+                for name, label in [("ndvi", "Scan: NDVI"), ("ndbi", "Scan: NDBI"), ("sprawl", "Scan: Sprawl")]:
+                    folium.raster_layers.TileLayer(
+                        tiles=scan_layers[name],
+                        attr="UrbanSight Scan",
+                        name=label,
+                        overlay=True,
+                        show=(name == "sprawl"),
+                        opacity=0.8,
+                        max_zoom=18
+                    ).add_to(m)
+                folium.LayerControl(collapsed=True).add_to(m)
+
+            # Interactive Layer for clicking
             folium.GeoJson(
-                sel_geom,
-                style_function=lambda x: {'fillColor': 'transparent', 'color': '#2997ff', 'weight': 3}
+                gdf,
+                style_function=lambda x: {'fillColor': '#00000000', 'color': '#00000000'},
+                highlight_function=lambda x: {'fillColor': '#ffffff', 'fillOpacity': 0.1, 'weight': 1},
+                tooltip=folium.GeoJsonTooltip(fields=['d_key'], aliases=['District:'])
             ).add_to(m)
-            # Zoom to selected
-            b = sel_geom.total_bounds
-            m.fit_bounds([[b[1], b[0]], [b[3], b[2]]])
-
-        # Interactive Layer for clicking
-        folium.GeoJson(
-            gdf,
-            style_function=lambda x: {'fillColor': '#00000000', 'color': '#00000000'},
-            highlight_function=lambda x: {'fillColor': '#ffffff', 'fillOpacity': 0.1, 'weight': 1},
-            tooltip=folium.GeoJsonTooltip(fields=['d_name'], aliases=['District:'])
-        ).add_to(m)
-
-        st_map = st_folium(m, width="100%", height=500, returned_objects=["last_object_clicked"])
-
-        # Click Logic
-        if st_map and st_map['last_object_clicked']:
-             props = st_map['last_object_clicked'].get('properties')
-             if props and 'd_name' in props:
-                 clicked_d = props['d_name']
-                 if clicked_d != st.session_state.selected_district:
-                     st.session_state.selected_district = clicked_d
-                     st.rerun()
+
+            st_map = st_folium(m, width="100%", height=500, returned_objects=["last_object_clicked"])
+
+            # Click Logic
+            if st_map and st_map['last_object_clicked']:
+                 props = st_map['last_object_clicked'].get('properties')
+                 if props and 'd_key' in props:
+                     clicked_d = props['d_key']
+                     if clicked_d != st.session_state.selected_district:
+                         st.session_state.selected_district = clicked_d
+                         st.rerun()
+        else:
+            st.caption("The map loads district outlines for all of India, switch it on to draw it.")
 
     with col_details:
         st.markdown('<div class="explained-card">', unsafe_allow_html=True)
@@ -247,7 +285,7 @@ with tab1:
         report_bytes = generate_pdf(
             selected_district, 
             d_stats.to_dict(), 
-            [f"NDVI Status: {ndvi_txt}", f"Urban Density: {ndbi_txt}", f"Risk Level: {risk_txt}"]
+            district_insights(d_stats)
         )
         st.download_button(
             label="📄 Download District Report",
@@ -263,9 +301,21 @@ with st.sidebar:
     st.markdown("### ⚖️ Comparison Mode")
     compare_mode = st.checkbox("Enable Comparison")
     if compare_mode:
+        # most similar districts first, the rest alphabetically
+        try:
+            similar = [n for n, _ in load_index(STATS_PATH, HIST_PATH, SHAPEFILE_PATH).query(selected_district, k=5)]
+        except Exception as e:
+            st.warning(f"Similarity search unavailable: {e}")
+            similar = []
+        similar = [d for d in similar if d in district_list]
+        options = similar + [d for d in district_list if d != selected_district and d not in similar]
+
+        if similar:
+            st.caption("Most similar: " + ", ".join(similar))
+
         compare_district = st.selectbox(
             "Compare with", 
-            [d for d in district_list if d != selected_district],
+            options,
             index=0
         )
 
@@ -273,7 +323,7 @@ if compare_mode:
     # Overlay Comparison View
     st.markdown(f"## ⚔️ Comparative Analysis: {selected_district} vs {compare_district}")
     
-    c_stats = gdf[gdf['d_name'] == compare_district].iloc[0]
+    c_stats = stats_df[stats_df['d_key'] == compare_district].iloc[0]
     
     col1, col2 = st.columns(2)
     
@@ -322,7 +372,7 @@ with tab2:
     # 1. Check for Real Scan Results
     if "scan_result" in st.session_state and st.session_state.scan_result:
         st.markdown("### 🛰️ Live Satellite Imagery Analysis")
-        ndvi, ndbi, slums, prof = st.session_state.scan_result
+        ndvi, ndbi, slums, prof = unpack_result(st.session_state.scan_result)
         
         s1, s2, s3 = st.columns(3)
         with s1:
@@ -353,6 +403,11 @@ with tab2:
             ax3.axis('off')
             st.pyplot(fig3)
             plt.close(fig3)
+
+        skipped = prof.get('skipped_tiles', [])
+        if skipped:
+            with st.expander(f"Tile screening: {len(skipped)} tiles skipped"):
+                st.dataframe(pd.DataFrame(skipped), use_container_width=True)
             
         st.divider()
 
@@ -398,24 +453,30 @@ with tab2:
     
     st.altair_chart(chart, use_container_width=True)
     
-    # Distribution Comparison (Mock for visual if no scan, or real logic)
+    # Distribution Comparison (precomputed histograms from scans)
     st.markdown("### District Distribution Models")
-    c1, c2 = st.columns(2)
-    with c1:
-        dist_data = np.random.normal(d_stats['mean_ndvi'], 0.15, 500)
-        df_hist = pd.DataFrame({'NDVI': dist_data})
-        hist_chart = alt.Chart(df_hist).mark_bar(color='#30d158', opacity=0.7).encode(
-            alt.X("NDVI", bin=alt.Bin(maxbins=20)), y='count()',
-        ).properties(height=200)
-        st.altair_chart(hist_chart, use_container_width=True)
-        
-    with c2:
-        dist_data_b = np.random.normal(d_stats['mean_ndbi'], 0.15, 500)
-        df_hist_b = pd.DataFrame({'NDBI': dist_data_b})
-        hist_chart_b = alt.Chart(df_hist_b).mark_bar(color='#ff453a', opacity=0.7).encode(
-            alt.X("NDBI", bin=alt.Bin(maxbins=20)), y='count()',
-        ).properties(height=200)
-        st.altair_chart(hist_chart_b, use_container_width=True)
+    d_hist = get_histograms().get(selected_district)
+    if d_hist is None:
+        st.info("No pixel distribution recorded for this district yet. Run a satellite scan to build one.")
+    else:
+        edges = bin_edges(len(d_hist['ndvi']))
+        c1, c2 = st.columns(2)
+        for col, key, label, color in [(c1, 'ndvi', 'NDVI', '#30d158'), (c2, 'ndbi', 'NDBI', '#ff453a')]:
+            with col:
+                counts = d_hist[key]
+                df_hist = pd.DataFrame({
+                    'start': edges[:-1],
+                    'end': edges[1:],
+                    'share': counts / max(counts.sum(), 1)
+                })
+                hist_chart = alt.Chart(df_hist).mark_bar(color=color, opacity=0.7).encode(
+                    x=alt.X('start:Q', title=label), x2='end:Q',
+                    y=alt.Y('share:Q', title='Share of pixels', axis=alt.Axis(format='%')),
+                ).properties(height=200)
+                st.altair_chart(hist_chart, use_container_width=True)
+
+                q = dict(zip(QUANTILES, d_hist[f'{key}_q']))
+                st.caption(f"Median {q[0.5]:.2f} · IQR {q[0.25]:.2f} to {q[0.75]:.2f}")
 
 # --- Tab 3: Intelligence ---
 with tab3:
@@ -0,0 +1,297 @@
+import os
+import time
+import atexit
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from indices import calculate_ndvi, calculate_ndbi, detect_sprawl
+
+FEATURES = ["B04", "B08", "B11", "ndvi", "ndbi"]
+CHUNK = 1 << 18   # pixels per inference task
+
+def pixel_features(red, nir, swir, ndvi, ndbi, dtype=np.float32):
+    # (n_features, n_pixels), row-major so a chunk is a contiguous column range
+    return np.stack([np.ravel(a) for a in (red, nir, swir, ndvi, ndbi)]).astype(dtype)
+
+class ThresholdClassifier:
+    """The fixed NDVI/NDBI rule from indices.detect_sprawl."""
+
+    def predict(self, red, nir, swir, ndvi, ndbi):
+        return detect_sprawl(ndvi, ndbi)
+
+class CompiledTree:
+    """
+    A fitted binary DecisionTreeClassifier turned into numpy comparisons on
+    the feature arrays themselves, so no (n_features, n_pixels) copy is
+    built and sklearn's per-call input checks are skipped.
+
+    Subtrees whose leaves all give the same class are collapsed first, then
+    each remaining split becomes `(x <= t) & left | (x > t) & right`.
+    Pixels with a non-finite value in any feature give 0, like the pool
+    path, including features the tree never tests.
+    """
+
+    def __init__(self, model):
+        t = model.tree_
+        self.t = t
+        self.labels = model.classes_[t.value[:, 0].argmax(axis=1)].astype(bool)
+        # float32 thresholds that split float32 pixels exactly like the float64 ones
+        thr = t.threshold.astype(np.float32)
+        over = thr.astype(np.float64) > t.threshold
+        thr[over] = np.nextafter(thr[over], np.float32(-np.inf))
+        self.thr = thr
+        self.root = self._collapse(0)
+
+    @classmethod
+    def supports(cls, model):
+        return type(model).__name__ == "DecisionTreeClassifier" and len(model.classes_) == 2
+
+    def _collapse(self, n):
+        # a node is either a bool (pure subtree) or (feature, threshold, left, right)
+        t = self.t
+        if t.children_left[n] < 0:
+            return bool(self.labels[n])
+        left = self._collapse(t.children_left[n])
+        right = self._collapse(t.children_right[n])
+        if isinstance(left, bool) and left == right:
+            return left
+        return (t.feature[n], self.thr[n], left, right)
+
+    def splits(self, node=None):
+        node = self.root if node is None else node
+        if isinstance(node, bool):
+            return 0
+        return 1 + self.splits(node[2]) + self.splits(node[3])
+
+    def _eval(self, node, f):
+        if isinstance(node, bool):
+            return node
+        k, thr, left, right = node
+        x = f[k]
+        out = False
+        if left is not False:
+            a = x <= thr
+            out = a if left is True else a & self._eval(left, f)
+        if right is not False:
+            b = x > thr
+            b = b if right is True else b & self._eval(right, f)
+            out = b if out is False else out | b
+        return out
+
+    def predict(self, red, nir, swir, ndvi, ndbi, chunk=CHUNK):
+        f = [np.ravel(a) for a in (red, nir, swir, ndvi, ndbi)]
+        n = f[0].size
+        out = np.zeros(n, dtype=bool)
+
+        # chunked so the temporaries stay in cache
+        for s in range(0, n, chunk):
+            c = [a[s:s + chunk] for a in f]
+            valid = np.isfinite(c[0])
+            for a in c[1:]:
+                valid &= np.isfinite(a)
+            out[s:s + chunk] = self._eval(self.root, c) & valid
+        return out.reshape(np.shape(ndvi))
+
+# --- Worker side ---
+_models = {}
+
+def load_model(path):
+    # loaded once per process and reused for every chunk
+    if path not in _models:
+        import joblib
+        _models[path] = joblib.load(path)
+    return _models[path]
+
+def predict_chunk(model_path, x_name, out_name, n_pixels, start, stop):
+    """
+    Classifies pixels [start, stop) of the shared feature array and writes
+    the labels into the shared output array. Pixels with a nan feature are
+    left as 0.
+    """
+    model = load_model(model_path)
+
+    x_shm = shared_memory.SharedMemory(name=x_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        X = np.ndarray((len(FEATURES), n_pixels), dtype=np.float32, buffer=x_shm.buf)
+        out = np.ndarray((n_pixels,), dtype=np.uint8, buffer=out_shm.buf)
+
+        x = X[:, start:stop].T
+        valid = np.isfinite(x).all(axis=1)
+        res = np.zeros(stop - start, dtype=np.uint8)
+        if valid.any():
+            res[valid] = model.predict(x[valid]).astype(np.uint8)
+        out[start:stop] = res
+        del X, out, x
+    finally:
+        x_shm.close()
+        out_shm.close()
+
+    return stop - start
+
+# --- Main side ---
+_pools = {}
+
+def get_pool(model_path, workers):
+    # one pool per model, workers load the model in their initializer
+    key = (model_path, workers)
+    if key not in _pools:
+        _pools[key] = ProcessPoolExecutor(
+            max_workers=workers, initializer=load_model, initargs=(model_path,)
+        )
+    return _pools[key]
+
+def shutdown_pools():
+    for pool in _pools.values():
+        pool.shutdown(cancel_futures=True)
+    _pools.clear()
+
+atexit.register(shutdown_pools)
+
+class ModelClassifier:
+    """
+    Applies a trained scikit-learn model (saved with joblib) to per-pixel
+    B04/B08/B11/NDVI/NDBI features.
+
+    The features are copied once into shared memory and classified in
+    fixed-size chunks across a process pool; each worker writes its labels
+    straight into a shared output array, so only chunk offsets cross the
+    process boundary. With workers=1 everything runs in this process.
+
+    Binary decision trees skip all of that and run as a CompiledTree in
+    this process, which is faster than any pool for them.
+    """
+
+    def __init__(self, model_path, workers=None, chunk=CHUNK, compile=True):
+        self.model_path = os.path.abspath(model_path)
+        self.workers = workers or os.cpu_count()
+        self.chunk = chunk
+
+        model = load_model(self.model_path)
+        self.compiled = CompiledTree(model) if compile and CompiledTree.supports(model) else None
+
+    def predict(self, red, nir, swir, ndvi, ndbi):
+        if self.compiled is not None:
+            return self.compiled.predict(red, nir, swir, ndvi, ndbi, self.chunk)
+
+        shape = np.shape(ndvi)
+        n = int(np.prod(shape))
+
+        x_shm = shared_memory.SharedMemory(create=True, size=len(FEATURES) * n * 4)
+        out_shm = shared_memory.SharedMemory(create=True, size=n)
+        try:
+            X = np.ndarray((len(FEATURES), n), dtype=np.float32, buffer=x_shm.buf)
+            # each feature goes straight into its shared row, no stacked copy first
+            for k, a in enumerate((red, nir, swir, ndvi, ndbi)):
+                X[k] = np.ravel(a)
+
+            jobs = [
+                (self.model_path, x_shm.name, out_shm.name, n, s, min(s + self.chunk, n))
+                for s in range(0, n, self.chunk)
+            ]
+
+            if self.workers == 1:
+                for j in jobs:
+                    predict_chunk(*j)
+            else:
+                pool = get_pool(self.model_path, self.workers)
+                list(pool.map(predict_chunk, *zip(*jobs)))
+
+            out = np.ndarray((n,), dtype=np.uint8, buffer=out_shm.buf).astype(bool)
+            del X
+        finally:
+            x_shm.close()
+            x_shm.unlink()
+            out_shm.close()
+            out_shm.unlink()
+
+        return out.reshape(shape)
+
+def get_classifier(spec=None, **kwargs):
+    """
+    None or "threshold" gives the fixed rule, anything else is taken as the
+    path of a joblib model. Classifier objects are passed through.
+    """
+    if spec is None or spec == "threshold":
+        return ThresholdClassifier()
+    if isinstance(spec, str):
+        return ModelClassifier(spec, **kwargs)
+    return spec
+
+def train_model(X, y, path, model=None):
+    """
+    Fits `model` (a shallow decision tree by default, which ModelClassifier
+    compiles to numpy comparisons) on (n_pixels, n_features) samples and
+    saves it with joblib.
+    """
+    import joblib
+    from sklearn.tree import DecisionTreeClassifier
+
+    if model is None:
+        model = DecisionTreeClassifier(max_depth=8)
+
+    model.fit(X, y)
+    joblib.dump(model, path)
+    print("saved model to", path)
+    return model
+
+def benchmark(size=2000, model_path=None, workers=None, repeat=3):
+    """
+    Pixels/second of the threshold rule against a model on synthetic bands.
+
+    Without `model_path`, a tree is trained on the threshold labels of a
+    sample so the comparison runs anywhere.
+    """
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    red, nir, swir = [rng.integers(1, 6000, (size, size)).astype(np.float32) for _ in range(3)]
+    ndvi = calculate_ndvi(red, nir)
+    ndbi = calculate_ndbi(swir, nir)
+    n = size * size
+
+    if model_path is None:
+        X = pixel_features(red, nir, swir, ndvi, ndbi)[:, :200000].T
+        y = detect_sprawl(X[:, 3], X[:, 4])
+        model_path = os.path.join(tempfile.gettempdir(), "urbansight_bench_model.joblib")
+        train_model(X, y, model_path)
+
+    def run(clf):
+        clf.predict(red, nir, swir, ndvi, ndbi)  # warm up, starts workers
+        best = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            clf.predict(red, nir, swir, ndvi, ndbi)
+            dt = time.perf_counter() - t
+            best = dt if best is None else min(best, dt)
+        return n / best
+
+    base = run(ThresholdClassifier())
+    print(f"threshold: {base / 1e6:.1f} Mpx/s")
+
+    clf = ModelClassifier(model_path)
+    if clf.compiled is not None:
+        rate = run(clf)
+        print(f"compiled tree ({clf.compiled.splits()} splits): {rate / 1e6:.1f} Mpx/s, "
+              f"{base / rate:.1f}x slower than threshold")
+
+    for w in sorted({1, workers or os.cpu_count()}):
+        pooled = ModelClassifier(model_path, workers=w, compile=False)
+        rate = run(pooled)
+        print(f"model ({w} workers): {rate / 1e6:.1f} Mpx/s, {base / rate:.1f}x slower than threshold")
+
+    if clf.compiled is not None:
+        same = clf.predict(red, nir, swir, ndvi, ndbi) == pooled.predict(red, nir, swir, ndvi, ndbi)
+        print(f"compiled agrees with the model on {100 * same.mean():.4f}% of pixels")
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--model", type=str, default=None)
+    p.add_argument("--size", type=int, default=2000)
+    p.add_argument("--workers", type=int, default=None)
+
+    a = p.parse_args()
+
+    benchmark(a.size, a.model, a.workers)
@@ -1,6 +1,20 @@
 import geopandas as gpd
+import pandas as pd
 import os
 
+STATE_COL = "st_nm"
+
+def district_key(name, state=None):
+    # one id per district: "Name (State)", the bare name if the state is unknown
+    if state is None or pd.isna(state):
+        return name
+    return f"{name} ({state})"
+
+def add_keys(df, state_col=STATE_COL):
+    states = df[state_col] if state_col in df.columns else [None] * len(df)
+    df['d_key'] = [district_key(n, s) for n, s in zip(df['d_name'], states)]
+    return df
+
 def load_districts(path):
     if not os.path.exists(path):
         print("file not found")
@@ -12,6 +26,84 @@ def load_districts(path):
     
     return df
 
+def merge_stats(df, stats, state_col=STATE_COL):
+    """
+    Joins stats rows onto the districts by d_key.
+
+    Rows written before the table had states have a bare-name key. They
+    are used for districts whose name is unique; names found more than once
+    can't be told apart and are left empty until they are refreshed.
+    """
+    stats = add_keys(stats.copy(), state_col)
+    values = [c for c in stats.columns if c not in ('d_key', 'd_name', state_col)]
+
+    dup = stats['d_key'].duplicated(keep=False)
+    if dup.any():
+        print("ambiguous rows in the stats table, ignored:", sorted(set(stats['d_key'][dup])))
+        stats = stats[~dup]
+
+    out = df.merge(stats[['d_key'] + values], on="d_key", how="left")
+
+    if state_col in df.columns:
+        old = stats[stats['d_key'] == stats['d_name']].set_index('d_name')[values]
+        unique = ~out['d_name'].duplicated(keep=False)
+        fill = out[values].isna().all(axis=1) & unique & out['d_name'].isin(old.index)
+        out.loc[fill, values] = old.loc[out.loc[fill, 'd_name']].values
+
+    return out
+
+def load_district_table(path, stats_path=None, state_col=STATE_COL):
+    # names + stats only, the .dbf is read but no geometry is parsed
+    if not os.path.exists(path):
+        print("file not found")
+        return None
+
+    df = pd.DataFrame(gpd.read_file(path, ignore_geometry=True))
+    cols = ['d_name'] + ([state_col] if state_col in df.columns else [])
+    df = add_keys(df[cols].dropna(subset=['d_name']), state_col).drop_duplicates('d_key')
+
+    if stats_path and os.path.exists(stats_path):
+        df = merge_stats(df, pd.read_csv(stats_path), state_col)
+    else:
+        # Fallback defaults
+        df['mean_ndvi'] = 0.3
+        df['mean_ndbi'] = 0.05
+        df['sprawl_risk'] = 10.0
+
+    return df.reset_index(drop=True)
+
+def load_simplified(path, cache_path, tol=0.002):
+    """
+    Loads district outlines simplified with `tol`.
+
+    The simplified layer is written next to `cache_path`, with `tol` in
+    the file name, on first use and read from there afterwards, as long as
+    it is newer than the source shapefile.
+    """
+    if not os.path.exists(path):
+        print("file not found")
+        return None
+
+    root, ext = os.path.splitext(cache_path)
+    cache_path = f"{root}_{tol:g}{ext}"
+
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return gpd.read_file(cache_path)
+
+    df = load_districts(path)
+    cols = ['d_name'] + ([STATE_COL] if STATE_COL in df.columns else [])
+    df = add_keys(df[cols + ['geometry']].dropna(subset=['d_name']))
+    df['geometry'] = df['geometry'].simplify(tol)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        df.to_file(cache_path, driver="GPKG")
+        print("cached simplified geometries to", cache_path)
+    except Exception as e:
+        print("could not write cache:", e)
+
+    return df
+
 if __name__ == "__main__":
     p = "data/district.shp"
     load_districts(p)
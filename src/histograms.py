@@ -0,0 +1,98 @@
+import os
+import numpy as np
+from indices import INDEX_SCALE, INDEX_NODATA, quantize_index
+
+HIST_BINS = 40       # fixed bins over [-1, 1], 0.05 wide
+BLOCK_ROWS = 512     # rows binned at a time
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+HIST_FILE = "district_hist.npz"
+
+def hist_path_for(stats_path):
+    # the table lives next to district_stats.csv
+    return os.path.join(os.path.dirname(stats_path), HIST_FILE)
+
+def bin_edges(bins=HIST_BINS):
+    return np.linspace(-1, 1, bins + 1)
+
+def bin_index(arr, bins=HIST_BINS):
+    """
+    Bin number of every valid pixel of `arr` (float, or int16 from
+    quantize_index). Nodata pixels are dropped, so the result is 1-D.
+    """
+    q = arr if arr.dtype == np.int16 else quantize_index(arr)
+    q = q[q != INDEX_NODATA].astype(np.int64)
+    # +1.0 lands exactly on `bins`, it belongs to the last bin
+    return np.minimum((q + INDEX_SCALE) * bins // (2 * INDEX_SCALE), bins - 1)
+
+def index_histogram(arr, bins=HIST_BINS, block=BLOCK_ROWS):
+    # block-wise so large rasters never need a full sorted or quantized copy
+    hist = np.zeros(bins, dtype=np.int64)
+    for r in range(0, arr.shape[0], block):
+        hist += np.bincount(bin_index(arr[r:r + block], bins), minlength=bins)
+    return hist
+
+def hist_quantiles(hist, qs=QUANTILES):
+    # read off the cumulative histogram, linear within a bin
+    hist = np.asarray(hist)
+    cdf = np.cumsum(hist)
+    total = cdf[-1] if len(cdf) else 0
+    if total == 0:
+        return np.full(len(qs), np.nan)
+
+    edges = bin_edges(len(hist))
+    out = []
+    for q in qs:
+        target = q * total
+        i = min(int(np.searchsorted(cdf, target)), len(hist) - 1)
+        prev = cdf[i - 1] if i > 0 else 0
+        frac = (target - prev) / hist[i] if hist[i] else 0
+        out.append(edges[i] + frac * (edges[i + 1] - edges[i]))
+    return np.array(out)
+
+def load_table(path):
+    """
+    Reads the histogram table.
+
+    Returns a dict of district name -> {"ndvi", "ndbi", "ndvi_q", "ndbi_q"}
+    or an empty dict if there is no table yet.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    # each array is read (and decompressed) once, then sliced per district
+    with np.load(path, allow_pickle=False) as z:
+        names = z['d_name']
+        ndvi, ndbi, ndvi_q, ndbi_q = z['ndvi'], z['ndbi'], z['ndvi_q'], z['ndbi_q']
+
+    return {
+        str(n): {"ndvi": ndvi[k], "ndbi": ndbi[k], "ndvi_q": ndvi_q[k], "ndbi_q": ndbi_q[k]}
+        for k, n in enumerate(names)
+    }
+
+def update_table(path, rows):
+    """
+    Adds or replaces districts in the table.
+
+    `rows` maps district name -> {"ndvi": hist, "ndbi": hist}. The table is
+    stored column-wise (one array per field) in a compressed .npz.
+    """
+    table = load_table(path)
+    for name, h in rows.items():
+        table[name] = {"ndvi": np.asarray(h['ndvi']), "ndbi": np.asarray(h['ndbi'])}
+
+    names = sorted(table)
+    ndvi = np.array([table[n]['ndvi'] for n in names], dtype=np.int64)
+    ndbi = np.array([table[n]['ndbi'] for n in names], dtype=np.int64)
+
+    tmp = path + ".tmp.npz"
+    np.savez_compressed(
+        tmp,
+        d_name=np.array(names),
+        ndvi=ndvi,
+        ndbi=ndbi,
+        ndvi_q=np.array([hist_quantiles(h) for h in ndvi], dtype=np.float32),
+        ndbi_q=np.array([hist_quantiles(h) for h in ndbi], dtype=np.float32),
+        quantiles=np.array(QUANTILES),
+    )
+    os.replace(tmp, path)
+    print("updated", path, "with", len(rows), "districts")
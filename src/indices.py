@@ -16,3 +16,64 @@ def normalize(arr):
     mn = np.nanmin(arr)
     mx = np.nanmax(arr)
     return (arr - mn) / (mx - mn)
+
+def detect_sprawl(ndvi, ndbi):
+    # built-up and sparsely vegetated
+    return (ndbi > 0.05) & (ndvi < 0.3)
+
+# --- Compact storage ---
+# Indices are kept as int16 scaled by INDEX_SCALE (1e-4 steps, well below the
+# 2 decimals shown) with one value reserved for nodata.
+INDEX_SCALE = 10000
+INDEX_NODATA = -32768
+
+def quantize_index(arr):
+    nodata = ~np.isfinite(arr)
+    q = np.round(np.clip(np.nan_to_num(arr), -1, 1) * INDEX_SCALE)
+    q[nodata] = INDEX_NODATA
+    return q.astype(np.int16)
+
+def dequantize_index(q, dtype=np.float32):
+    out = q.astype(dtype) / dtype(INDEX_SCALE)
+    out[q == INDEX_NODATA] = np.nan
+    return out
+
+def pack_mask(mask):
+    # 8 pixels per byte, rows are kept so the width is needed to unpack
+    return np.packbits(mask, axis=1)
+
+def unpack_mask(packed, width):
+    return np.unpackbits(packed, axis=1, count=width).astype(bool)
+
+def quantization_error(ref, q):
+    """
+    Compares a compact index against its float64 reference.
+
+    Returns the max absolute error over valid pixels and the number of
+    pixels where nodata doesn't line up (should be 0).
+    """
+    back = dequantize_index(q, np.float64)
+    ref_nan = np.isnan(ref)
+    mismatch = int((ref_nan != np.isnan(back)).sum())
+    valid = ~ref_nan & ~np.isnan(back)
+    err = float(np.abs(back[valid] - ref[valid]).max()) if valid.any() else 0.0
+    return err, mismatch
+
+if __name__ == "__main__":
+    # accuracy check of the compact path against the float64 reference
+    rng = np.random.default_rng(0)
+    shape = (1000, 1000)
+    red, nir, swir = [rng.integers(0, 6000, shape).astype(float) for _ in range(3)]
+    red[:50] = np.nan
+
+    for name, fn, a, b in [("ndvi", calculate_ndvi, red, nir), ("ndbi", calculate_ndbi, swir, nir)]:
+        ref = fn(a, b)
+        q = quantize_index(fn(a.astype(np.float32), b.astype(np.float32)))
+        err, mismatch = quantization_error(ref, q)
+        print(name, "max error:", err, "nodata mismatch:", mismatch, "bytes:", ref.nbytes, "->", q.nbytes)
+        assert err <= 1.0 / INDEX_SCALE and mismatch == 0
+
+    ref = detect_sprawl(calculate_ndvi(red, nir), calculate_ndbi(swir, nir))
+    packed = pack_mask(ref)
+    assert (unpack_mask(packed, shape[1]) == ref).all()
+    print("sprawl bytes:", ref.nbytes, "->", packed.nbytes)
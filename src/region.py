@@ -0,0 +1,376 @@
+import os
+import math
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from data_loader import load_districts, district_key, STATE_COL
+from histograms import HIST_BINS, bin_index, update_table, hist_path_for
+from sentinel_client import find_images, screen_tiles, warp_band
+from indices import (
+    calculate_ndvi, calculate_ndbi, detect_sprawl,
+    quantize_index, dequantize_index, INDEX_NODATA
+)
+
+REGION_CRS = "EPSG:4326"
+REGION_RES = 0.0005  # degrees, roughly 50 m like the per-district scans
+BLOCK = 1024
+
+def region_grid(bounds, res=REGION_RES):
+    from rasterio.transform import from_origin
+
+    minx, miny, maxx, maxy = bounds
+    width = int(math.ceil((maxx - minx) / res))
+    height = int(math.ceil((maxy - miny) / res))
+    return from_origin(minx, maxy, res, res), width, height
+
+def block_windows(width, height, block=BLOCK):
+    from rasterio.windows import Window
+
+    for row in range(0, height, block):
+        for col in range(0, width, block):
+            yield Window(col, row, min(block, width - col), min(block, height - row))
+
+SCENES_PER_TILE = 3  # acquisitions kept per MGRS tile, later ones only fill gaps
+
+def scene_rank(item):
+    # most complete scene first (swath edges are mostly nodata), then least cloudy
+    p = item.properties
+    return tuple(100 if p.get(k) is None else p[k] for k in ("s2:nodata_pixel_percentage", "eo:cloud_cover"))
+
+def pick_items(items, per_tile=SCENES_PER_TILE):
+    """
+    The best few acquisitions per MGRS tile, ranked by scene_rank.
+
+    warp_band fills pixels in that order, so the best scene covers what it
+    can and the others only fill its holes (e.g. a swath edge), instead of
+    leaving them empty.
+    """
+    picked = {}
+    for i in sorted(items, key=scene_rank):
+        tile = i.properties.get("s2:mgrs_tile", i.id)
+        picked.setdefault(tile, [])
+        if len(picked[tile]) < per_tile:
+            picked[tile].append(i)
+    print("using", sum(len(v) for v in picked.values()), "scenes over", len(picked), "tiles for the region")
+    return [i for v in picked.values() for i in v]
+
+def process_block(window, transform, crs, items):
+    """
+    Builds NDVI/NDBI for one block of the region grid from `items`, the
+    region's scenes that touch this block.
+
+    Runs in a worker process. Returns (window, ndvi, ndbi, skipped) with
+    ndvi/ndbi None if nothing could be read; skipped lists the tiles left
+    out and why.
+    """
+    from rasterio.windows import bounds as window_bounds, transform as window_transform
+    from rasterio.warp import transform_bounds
+    from rasterio.enums import Resampling
+    from shapely.geometry import box
+    import planetary_computer
+
+    b = window_bounds(window, transform)
+    bbox = list(transform_bounds(crs, "EPSG:4326", *b))
+
+    tiles, skipped = screen_tiles(items, box(*bbox))
+    if len(tiles) == 0:
+        return window, None, None, skipped
+
+    # signed here, a region run can outlast the tokens of a search-time signature
+    tiles = [planetary_computer.sign(i) for i in tiles]
+
+    trans = window_transform(window, transform)
+    h, w = int(window.height), int(window.width)
+
+    # the pool already uses every core, so GDAL warps single threaded here
+    bands = [
+        warp_band(tiles, band, crs, trans, w, h, resampling=Resampling.average, num_threads=1, skipped=skipped)
+        for band in ["B04", "B08", "B11"]
+    ]
+    if any(x is None for x in bands):
+        return window, None, None, skipped
+
+    red, nir, swir = [x.astype("float32") for x in bands]
+
+    mask = (red > 0) & (nir > 0)
+    red[~mask] = np.nan
+    nir[~mask] = np.nan
+    swir[~mask] = np.nan
+
+    return window, calculate_ndvi(red, nir), calculate_ndbi(swir, nir), skipped
+
+def build_mosaic(districts, path, res=REGION_RES, block=BLOCK, workers=None,
+                 date_range="2023-01-01/2023-05-30", compact=False):
+    """
+    Writes a 2 band (NDVI, NDBI) float32 mosaic covering all `districts`,
+    or int16 scaled indices if `compact`.
+
+    The catalog is searched once for the whole region and the best few
+    scenes per MGRS tile are picked (pick_items). Items are signed in the
+    workers right before reading. The grid is split into blocks that get the scenes
+    touching them and are processed across a process pool. Tiles skipped
+    by screening or failed reads are written to <mosaic>_skipped.csv.
+    At most two blocks per worker are in flight and each one is written to
+    disk as soon as it finishes, so memory stays bounded for any region size.
+    """
+    import rasterio
+    from rasterio.windows import bounds as window_bounds
+    from shapely.geometry import box
+    from shapely.prepared import prep
+
+    d = districts.to_crs(REGION_CRS)
+    transform, width, height = region_grid(d.total_bounds, res)
+    print("mosaic grid:", width, "x", height)
+
+    # blocks that don't touch any district are never fetched
+    footprint = prep(d.geometry.unary_union)
+    todo = [
+        w for w in block_windows(width, height, block)
+        if footprint.intersects(box(*window_bounds(w, transform)))
+    ]
+    print("processing", len(todo), "blocks")
+
+    from shapely.geometry import shape
+    from shapely.strtree import STRtree
+
+    items = pick_items(find_images(list(d.total_bounds), date_range=date_range, sign=False))
+    tree = STRtree([shape(i.geometry) for i in items])
+
+    def block_items(w):
+        hits = sorted(tree.query(box(*window_bounds(w, transform)), predicate="intersects"))
+        # best first, so it wins where scenes overlap
+        return sorted((items[k] for k in hits), key=scene_rank)
+
+    workers = workers or os.cpu_count()
+
+    with rasterio.open(
+        path, "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=2,
+        dtype="int16" if compact else "float32",
+        crs=REGION_CRS,
+        transform=transform,
+        nodata=INDEX_NODATA if compact else np.nan,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    ) as dst:
+        dst.descriptions = ("NDVI", "NDBI")
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            skipped = []
+            done_count = 0
+
+            while todo or pending:
+                while todo and len(pending) < workers * 2:
+                    w = todo.pop()
+                    its = block_items(w)
+                    if not its:
+                        continue
+                    pending.add(pool.submit(process_block, w, transform, REGION_CRS, its))
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    try:
+                        w, ndvi, ndbi, block_skipped = fut.result()
+                    except Exception as e:
+                        print("block failed:", e)
+                        continue
+
+                    for x in block_skipped:
+                        skipped.append(dict(x, block_col=int(w.col_off), block_row=int(w.row_off)))
+
+                    if ndvi is not None:
+                        if compact:
+                            ndvi, ndbi = quantize_index(ndvi), quantize_index(ndbi)
+                        dst.write(ndvi.astype(dst.dtypes[0]), 1, window=w)
+                        dst.write(ndbi.astype(dst.dtypes[1]), 2, window=w)
+
+                    done_count += 1
+                    print("blocks done:", done_count)
+
+    # why tiles were left out of each block, next to the mosaic
+    skip_path = os.path.splitext(path)[0] + "_skipped.csv"
+    pd.DataFrame(skipped, columns=["block_col", "block_row", "id", "reason"]).to_csv(skip_path, index=False)
+    print("skipped tiles recorded in", skip_path)
+
+    return path
+
+def zonal_stats(path, districts, block=BLOCK, state_col=STATE_COL):
+    """
+    Extracts per-district stats from a mosaic in a single block-wise pass.
+
+    Every block is rasterized to district ids and the sums and NDVI/NDBI
+    histograms are accumulated with np.bincount, so no per-district crop is
+    ever made. Polygons are grouped by (state, name), so districts that
+    share a name stay apart. Returns the stats table and a dict of
+    district key ("Name (State)") -> histograms.
+    """
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.windows import bounds as window_bounds
+    from shapely.geometry import box
+
+    with rasterio.open(path) as src:
+        d = districts.to_crs(src.crs).reset_index(drop=True)
+        n = len(d) + 1
+
+        count = np.zeros(n)
+        s_ndvi = np.zeros(n)
+        s_ndbi = np.zeros(n)
+        s_sprawl = np.zeros(n)
+        h_ndvi = np.zeros(n * HIST_BINS, dtype=np.int64)
+        h_ndbi = np.zeros(n * HIST_BINS, dtype=np.int64)
+
+        for w in block_windows(src.width, src.height, block):
+            hits = d.sindex.query(box(*window_bounds(w, src.transform)))
+            if len(hits) == 0:
+                continue
+
+            shapes = [(d.geometry.iloc[i], int(i) + 1) for i in hits]
+            ids = rasterize(
+                shapes,
+                out_shape=(int(w.height), int(w.width)),
+                transform=src.window_transform(w),
+                fill=0,
+                dtype="int32",
+            )
+
+            ndvi, ndbi = src.read([1, 2], window=w)
+            if src.dtypes[0] == "int16":
+                ndvi, ndbi = dequantize_index(ndvi), dequantize_index(ndbi)
+            valid = (ids > 0) & ~np.isnan(ndvi) & ~np.isnan(ndbi)
+            if not valid.any():
+                continue
+
+            idv = ids[valid]
+            ndvi = ndvi[valid]
+            ndbi = ndbi[valid]
+
+            count += np.bincount(idv, minlength=n)
+            s_ndvi += np.bincount(idv, weights=ndvi, minlength=n)
+            s_ndbi += np.bincount(idv, weights=ndbi, minlength=n)
+            s_sprawl += np.bincount(idv, weights=detect_sprawl(ndvi, ndbi), minlength=n)
+            h_ndvi += np.bincount(idv * HIST_BINS + bin_index(ndvi), minlength=n * HIST_BINS)
+            h_ndbi += np.bincount(idv * HIST_BINS + bin_index(ndbi), minlength=n * HIST_BINS)
+
+    has_state = state_col in d.columns
+    if not has_state:
+        # no state to tell same-named districts apart, keep every polygon
+        print("no", state_col, "column, districts are not merged by name")
+        d[state_col] = np.arange(len(d))
+    keys = [state_col, "d_name"]
+
+    # equal-area projection, used by the similarity search
+    area = d.to_crs("EPSG:6933").area.values / 1e6
+    h_ndvi = h_ndvi.reshape(n, HIST_BINS)
+    h_ndbi = h_ndbi.reshape(n, HIST_BINS)
+
+    rows = []
+    hists = {}
+    # a district split over several polygons is summed over all of them
+    for key, idx in d.groupby(keys, sort=False).indices.items():
+        pos = idx + 1
+        c = count[pos].sum()
+        if c == 0:
+            continue
+
+        state = key[0] if has_state else None
+        rows.append({
+            state_col: state,
+            "d_name": key[1],
+            "mean_ndvi": s_ndvi[pos].sum() / c,
+            "mean_ndbi": s_ndbi[pos].sum() / c,
+            "sprawl_risk": 100 * s_sprawl[pos].sum() / c,
+            "area_km2": area[idx].sum(),
+        })
+        hists[district_key(key[1], state)] = {"ndvi": h_ndvi[pos].sum(axis=0), "ndbi": h_ndbi[pos].sum(axis=0)}
+
+    return pd.DataFrame(rows), hists
+
+def update_stats(path, new, state_col=STATE_COL):
+    """
+    Replaces the rows of the refreshed districts, keeps the rest.
+
+    Rows are matched on (state, name). Rows without a state (tables from
+    before states were recorded) can't be matched, so a refresh that names
+    the state replaces every stateless row with that name.
+    """
+    if os.path.exists(path):
+        old = pd.read_csv(path)
+        if state_col not in old.columns:
+            old[state_col] = np.nan
+
+        k_old = old[state_col].astype(str) + "|" + old['d_name']
+        k_new = new[state_col].astype(str) + "|" + new['d_name']
+        stale = old[state_col].isna() & old['d_name'].isin(new['d_name'][new[state_col].notna()])
+        if stale.any():
+            print("replaced rows without a state:", sorted(set(old['d_name'][stale])))
+
+        old = old[~(k_old.isin(k_new) | stale)]
+        new = pd.concat([old, new], ignore_index=True)
+
+    new.to_csv(path, index=False)
+    print("updated", path)
+
+def process_region(shp_path, state=None, state_col=STATE_COL, out="output", **kwargs):
+    """
+    Runs the mosaic + zonal pipeline for one state (or all of India if
+    `state` is None). Returns the stats table, the mosaic path and the
+    per-district histograms.
+    """
+    data = load_districts(shp_path)
+    if data is None:
+        return None
+
+    if state:
+        data = data[data[state_col] == state]
+        if data.empty:
+            print("state not found")
+            return None
+
+    data = data.dropna(subset=['d_name'])
+
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    tag = (state or "india").replace(" ", "_")
+    path = os.path.join(out, f"{tag}_mosaic.tif")
+
+    print("building mosaic for", tag)
+    build_mosaic(data, path, **kwargs)
+
+    print("extracting district stats...")
+    stats, hists = zonal_stats(path, data, state_col=state_col)
+    stats.to_csv(os.path.join(out, f"{tag}_stats.csv"), index=False)
+    update_table(os.path.join(out, f"{tag}_hist.npz"), hists)
+
+    return stats, path, hists
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--state", type=str, default=None)
+    p.add_argument("--state-col", type=str, default=STATE_COL)
+    p.add_argument("--shapefile", type=str, default="data/district.shp")
+    p.add_argument("--out", type=str, default="output")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--res", type=float, default=REGION_RES)
+    p.add_argument("--stats", type=str, default=None, help="district_stats.csv to update")
+    p.add_argument("--compact", action="store_true", help="store the mosaic as int16")
+
+    a = p.parse_args()
+
+    res = process_region(
+        a.shapefile, state=a.state, state_col=a.state_col, out=a.out,
+        workers=a.workers, res=a.res, compact=a.compact
+    )
+    if res is not None and a.stats:
+        update_stats(a.stats, res[0], state_col=a.state_col)
+        update_table(hist_path_for(a.stats), res[2])
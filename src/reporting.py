@@ -25,6 +25,29 @@ class DistrictReport(FPDF):
         self.multi_cell(0, 6, body)
         self.ln()
 
+def interpret_ndvi(val):
+    if val > 0.4: return "Very Green (Healthy)", "#30d158"
+    if val > 0.2: return "Moderate Greenery", "#ff9f0a"
+    return "Sparse Vegetation", "#ff453a"
+
+def interpret_ndbi(val):
+    if val > 0.1: return "High Urban Density", "#ff453a"
+    if val > -0.1: return "Moderate Built-up", "#ff9f0a"
+    return "Low Urbanization", "#30d158"
+
+def interpret_risk(val):
+    if val > 50: return "Critical Sprawl", "#ff453a"
+    if val > 20: return "Warning Level", "#ff9f0a"
+    return "Stable", "#30d158"
+
+def district_insights(stats):
+    # the bullet points shown in the dashboard and the PDF
+    return [
+        f"NDVI Status: {interpret_ndvi(stats['mean_ndvi'])[0]}",
+        f"Urban Density: {interpret_ndbi(stats['mean_ndbi'])[0]}",
+        f"Risk Level: {interpret_risk(stats['sprawl_risk'])[0]}",
+    ]
+
 def generate_pdf(district_name, stats, insights):
     """
     Generates a PDF report for a specific district.
@@ -1,16 +1,21 @@
 from pystac_client import Client
 import planetary_computer
 import rasterio
+import rasterio.errors
 from rasterio.io import MemoryFile
-from rasterio.merge import merge
 from rasterio.mask import mask
 import numpy as np
 from datetime import timedelta
 
 STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
 
-def find_images(bbox, date_range="2023-01-01/2023-12-31", cloud=10):
-    catalog = Client.open(STAC_URL, modifier=planetary_computer.sign_inplace)
+# The search is looser than the screening below, so tiles over MAX_CLOUD are
+# dropped by screen_tiles with a recorded reason instead of silently
+SEARCH_CLOUD = 20.0
+
+def find_images(bbox, date_range="2023-01-01/2023-12-31", cloud=SEARCH_CLOUD, sign=True):
+    # with sign=False the caller signs items (planetary_computer.sign) right before reading
+    catalog = Client.open(STAC_URL, modifier=planetary_computer.sign_inplace if sign else None)
     
     s = catalog.search(
         collections=["sentinel-2-l2a"],
@@ -39,91 +44,238 @@ def sort_images(items):
     print("using", len(final_list), "tiles from date", d.date())
     return final_list
 
-def get_band(items, band, s=0.25):
+# Pre-fetch screening, tiles failing any of these are never downloaded
+MAX_NODATA = 95.0   # s2:nodata_pixel_percentage of the whole tile
+MAX_CLOUD = 10.0    # eo:cloud_cover of the tile, below SEARCH_CLOUD
+MIN_COVER = 0.02    # share of the area a tile has to add to be worth reading
+
+def screen_tiles(items, area, max_nodata=MAX_NODATA, max_cloud=MAX_CLOUD, min_cover=MIN_COVER):
+    """
+    Drops tiles that would add few valid pixels to `area`, using only the
+    STAC metadata already in the search results.
+
+    `area` is a shapely geometry in EPSG:4326. Tiles are checked in order and
+    a tile only counts the part of `area` not already covered by the tiles
+    kept before it, so edge tiles overlapping a better one are dropped too.
+
+    Returns (kept, skipped) where skipped is a list of {"id", "reason"} dicts.
+    """
+    from shapely.geometry import shape
+
+    kept = []
+    skipped = []
+    covered = None
+    total = area.area
+
+    for i in items:
+        p = i.properties
+
+        nodata = p.get("s2:nodata_pixel_percentage")
+        if nodata is not None and nodata > max_nodata:
+            skipped.append({"id": i.id, "reason": f"nodata {nodata:.1f}%"})
+            continue
+
+        cloud = p.get("eo:cloud_cover")
+        if cloud is not None and cloud > max_cloud:
+            skipped.append({"id": i.id, "reason": f"cloud {cloud:.1f}%"})
+            continue
+
+        foot = shape(i.geometry).intersection(area)
+        if foot.is_empty:
+            skipped.append({"id": i.id, "reason": "outside area"})
+            continue
+
+        new = foot if covered is None else foot.difference(covered)
+        share = new.area / total if total > 0 else 0
+        if share < min_cover:
+            skipped.append({"id": i.id, "reason": f"adds {share:.1%} of area"})
+            continue
+
+        kept.append(i)
+        covered = foot if covered is None else covered.union(foot)
+
+    print("screening kept", len(kept), "of", len(items), "tiles")
+    return kept, skipped
+
+# Warp settings shared by every band of a scan
+WARP_THREADS = "ALL_CPUS"
+WARP_MEM_MB = 256
+
+# resampling used when a band is read onto the (coarser) scan grid
+BAND_RESAMPLING = {
+    "B04": "average",
+    "B08": "average",
+    "B11": "average",
+}
+
+def target_grid(items, band, s=0.25, bounds=None):
+    """
+    Output grid shared by all bands of a scan.
+
+    Uses the CRS of the first tile and its `band` pixel size divided by `s`.
+    The grid covers `bounds` (lon/lat) if given, otherwise all the tiles.
+    """
+    import math
+    from rasterio.warp import transform_bounds
+    from rasterio.transform import from_origin
+
+    with rasterio.open(items[0].assets[band].href) as f:
+        crs = f.crs
+        res = f.res[0] / s
+
+    if bounds is None:
+        boxes = [transform_bounds("EPSG:4326", crs, *i.bbox) for i in items]
+        bounds = (
+            min(b[0] for b in boxes),
+            min(b[1] for b in boxes),
+            max(b[2] for b in boxes),
+            max(b[3] for b in boxes),
+        )
+    else:
+        bounds = transform_bounds("EPSG:4326", crs, *bounds)
+
+    minx, miny, maxx, maxy = bounds
+    return {
+        "crs": crs,
+        "transform": from_origin(minx, maxy, res, res),
+        "width": max(1, int(math.ceil((maxx - minx) / res))),
+        "height": max(1, int(math.ceil((maxy - miny) / res))),
+    }
+
+def get_band(items, band, s=0.25, skipped=None, grid=None, resampling=None,
+             num_threads=WARP_THREADS, warp_mem_limit=WARP_MEM_MB):
     if not items:
         return None, None
 
-    from rasterio.vrt import WarpedVRT
-    
-    temp = []
-    tomerge = []
-    
-    def process(ds, crs):
-        h = int(ds.height * s)
-        w = int(ds.width * s)
-        
-        if h == 0 or w == 0:
-            return 
-            
-        d = ds.read(
-            1,
-            out_shape=(h, w),
-            resampling=rasterio.enums.Resampling.bilinear
-        )
-        
-        trans = ds.transform * ds.transform.scale(
-            (ds.width / d.shape[-1]),
-            (ds.height / d.shape[-2])
-        )
-        
-        m = MemoryFile()
-        dst = m.open(
-            driver='GTiff',
-            height=h,
-            width=w,
-            count=1,
-            dtype=d.dtype,
-            crs=crs,
-            transform=trans,
-        )
-        dst.write(d, 1)
-        return m, dst
+    from rasterio.enums import Resampling
+
+    if grid is None:
+        grid = target_grid(items, band, s)
+
+    if resampling is None:
+        resampling = BAND_RESAMPLING.get(band, "bilinear")
+
+    print("warping", band, "onto", grid['width'], "x", grid['height'])
+    img = warp_band(
+        items, band, grid['crs'], grid['transform'], grid['width'], grid['height'],
+        resampling=Resampling[resampling],
+        num_threads=num_threads,
+        warp_mem_limit=warp_mem_limit,
+        skipped=skipped,
+    )
 
-    item1 = items[0]
-    link1 = item1.assets[band].href
+    if img is None:
+        return None, None
+
+    prof = {
+        "transform": grid['transform'],
+        "height": grid['height'],
+        "width": grid['width'],
+        "crs": grid['crs'],
+        "count": 1
+    }
     
-    with rasterio.open(link1) as f1:
-        crs1 = f1.crs
-        m, d = process(f1, crs1)
-        temp.append(m)
-        tomerge.append(d)
-        
-    for i in items[1:]:
+    return img, prof
+
+# native pixel size in metres, used when an asset has no gsd
+NATIVE_RES = {"B04": 10, "B08": 10, "B11": 20}
+
+def native_res(item, band):
+    a = item.assets[band]
+    gsd = a.extra_fields.get("gsd")
+    if gsd is None:
+        rb = a.extra_fields.get("raster:bands") or [{}]
+        gsd = rb[0].get("spatial_resolution")
+    return gsd or NATIVE_RES.get(band, 10)
+
+def pixel_size_m(crs, transform, height):
+    # smallest pixel side of the target grid in metres
+    import math
+
+    if crs.is_geographic:
+        lat = transform.f + transform.e * height / 2
+        return abs(transform.a) * 111320 * math.cos(math.radians(lat))
+    return min(abs(transform.a), abs(transform.e)) * crs.linear_units_factor[1]
+
+def overview_level(native, target):
+    """
+    Coarsest overview still finer than `target` (both in metres), None for
+    full resolution. Sentinel-2 COGs carry 2x, 4x, 8x ... overviews, so
+    level k is 2 ** (k + 1) times coarser than native.
+    """
+    import math
+
+    ratio = target / native
+    if ratio < 2:
+        return None
+    return int(math.floor(math.log2(ratio))) - 1
+
+def warp_band(items, band, crs, transform, width, height, resampling=None,
+              num_threads=WARP_THREADS, warp_mem_limit=WARP_MEM_MB, skipped=None):
+    """
+    Reads one band of every tile straight onto a fixed target grid.
+
+    Each tile is opened once, at the overview matching the target pixel
+    size (picked from STAC metadata, in metres, so geographic grids get
+    overviews too), and warped with GDAL's multithreaded warper. Tiles in
+    another UTM zone go through the same path. Tiles are applied in order
+    and only fill pixels that are still empty, so the first (least cloudy)
+    tile wins where they overlap.
+    """
+    from rasterio.vrt import WarpedVRT
+    from rasterio.enums import Resampling
+    from rasterio.crs import CRS
+
+    if resampling is None:
+        resampling = Resampling.bilinear
+
+    target = pixel_size_m(CRS.from_user_input(crs), transform, height)
+
+    def open_tile(link, level):
+        if level is None:
+            return rasterio.open(link)
+        try:
+            return rasterio.open(link, overview_level=level)
+        except rasterio.errors.RasterioIOError:
+            # fewer overviews than expected, read at full resolution
+            return rasterio.open(link)
+
+    out = None
+    for i in items:
         link = i.assets[band].href
         try:
-            with rasterio.open(link) as f:
-                if f.crs != crs1:
-                   with WarpedVRT(f, crs=crs1) as vrt:
-                       m, d = process(vrt, crs1)
-                else:
-                    m, d = process(f, crs1)
-                
-                temp.append(m)
-                tomerge.append(d)
+            with open_tile(link, overview_level(native_res(i, band), target)) as f:
+                with WarpedVRT(
+                    f,
+                    crs=crs,
+                    transform=transform,
+                    width=width,
+                    height=height,
+                    resampling=resampling,
+                    src_nodata=0,
+                    nodata=0,
+                    warp_mem_limit=warp_mem_limit,
+                    NUM_THREADS=num_threads,
+                ) as vrt:
+                    d = vrt.read(1)
         except Exception as e:
             print("error:", e)
+            if skipped is not None:
+                skipped.append({"id": i.id, "reason": f"read failed ({band}): {e}"})
             continue
 
-    if len(tomerge) == 0:
-        return None, None
+        if out is None:
+            out = d
+        else:
+            empty = out == 0
+            out[empty] = d[empty]
 
-    print("merging tiles...")
-    img, trans = merge(tomerge)
-    
-    for x in temp: 
-        x.close()
-    
-    prof = {
-        "transform": trans,
-        "height": img.shape[1],
-        "width": img.shape[2],
-        "crs": crs1,
-        "count": 1
-    }
-    
-    return img[0], prof
+        if not (out == 0).any():
+            break
+
+    return out
 
-def crop_data(arr, trans, shapes, crop=True):
+def crop_data(arr, trans, shapes, crop=True, dtype=float):
     from rasterio.features import geometry_mask
     
     r, c = arr.shape
@@ -135,7 +287,7 @@ def crop_data(arr, trans, shapes, crop=True):
         out_shape=(r, c)
     )
     
-    arr = arr.astype(float)
+    arr = arr.astype(dtype)
     arr[~m] = np.nan
     
     if crop:
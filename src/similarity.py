@@ -0,0 +1,215 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from histograms import HIST_BINS, bin_edges, load_table
+
+STAT_FEATURES = ["mean_ndvi", "mean_ndbi", "sprawl_risk", "area_km2"]
+HIST_WEIGHT = 1.0   # scale of the histogram part against the z-scored stats
+POINT_SIGMA = 0.1   # spread of the stand-in histogram for unscanned districts
+
+def hist_shares(hist):
+    hist = np.asarray(hist, dtype=float)
+    total = hist.sum()
+    return hist / total if total > 0 else hist
+
+def point_hist(val, bins=HIST_BINS, sigma=POINT_SIGMA):
+    """
+    Stand-in for districts that were never scanned: a Gaussian around the
+    mean, as pixel shares. A one-hot bin would put every unscanned district
+    at the maximum distance from any real histogram unless the means fell
+    in the same bin.
+    """
+    h = np.zeros(bins)
+    if np.isfinite(val):
+        edges = bin_edges(bins)
+        centres = (edges[:-1] + edges[1:]) / 2
+        h = np.exp(-0.5 * ((centres - val) / sigma) ** 2)
+        h /= h.sum()
+    return h
+
+class SimilarityIndex:
+    """
+    Nearest-neighbour index over district spectral signatures.
+
+    Districts are keyed by d_key ("Name (State)", see data_loader), the
+    key the stats table and histogram table use. Each district is a
+    vector of its z-scored stats (NDVI/NDBI means,
+    sprawl risk and log area when the table has it) followed by its NDVI
+    and NDBI histograms as pixel shares. Raw vectors are kept per district
+    and only recomputed for rows whose inputs changed, then the BallTree
+    is rebuilt over the (small) matrix.
+    """
+
+    def __init__(self, leaf_size=20):
+        self.leaf_size = leaf_size
+        self.raw = {}
+        self.keys = {}
+        self.names = []
+        self.tree = None
+
+    def _row(self, r, hist):
+        stats = []
+        for c in self.columns:
+            v = float(r[c]) if pd.notna(r[c]) else np.nan
+            stats.append(np.log1p(v) if c == "area_km2" and np.isfinite(v) else v)
+
+        if hist is not None:
+            h = [hist_shares(hist['ndvi']), hist_shares(hist['ndbi'])]
+        else:
+            h = [point_hist(r.get('mean_ndvi', np.nan)), point_hist(r.get('mean_ndbi', np.nan))]
+
+        return np.array(stats), np.concatenate(h)
+
+    def update(self, stats_df, hists=None):
+        from sklearn.neighbors import BallTree
+
+        hists = hists or {}
+        self.columns = [c for c in STAT_FEATURES if c in stats_df.columns]
+        if 'd_key' not in stats_df.columns:
+            from data_loader import add_keys
+            stats_df = add_keys(stats_df.copy())
+
+        # districts without any stats (never scanned) have nothing to compare
+        stats_df = stats_df.dropna(subset=['d_key']).dropna(subset=self.columns, how='all')
+        dup = stats_df['d_key'].duplicated(keep=False)
+        if dup.any():
+            # old rows without a state, there is no telling which district they are
+            print("left out, several rows share these keys:", sorted(set(stats_df['d_key'][dup])))
+            stats_df = stats_df[~dup]
+
+        names = list(stats_df['d_key'])
+        changed = 0
+        for _, r in stats_df.iterrows():
+            name = r['d_key']
+            hist = hists.get(name)
+            key = (
+                tuple(r[c] if pd.notna(r[c]) else None for c in self.columns),
+                None if hist is None else (hist['ndvi'].tobytes(), hist['ndbi'].tobytes()),
+            )
+            if self.keys.get(name) != key:
+                self.raw[name] = self._row(r, hist)
+                self.keys[name] = key
+                changed += 1
+
+        for name in set(self.raw) - set(names):
+            del self.raw[name]
+            del self.keys[name]
+
+        if changed == 0 and self.tree is not None and names == self.names:
+            return
+
+        stats = np.array([self.raw[n][0] for n in names])
+        hist = np.array([self.raw[n][1] for n in names])
+
+        # missing stats get the column median, then everything is z-scored
+        with np.errstate(all='ignore'):
+            med = np.nan_to_num(np.nanmedian(stats, axis=0))
+        stats = np.where(np.isnan(stats), med, stats)
+        std = stats.std(axis=0)
+        stats = (stats - stats.mean(axis=0)) / np.where(std > 0, std, 1)
+
+        self.names = names
+        self.pos = {n: k for k, n in enumerate(names)}
+        self.X = np.hstack([stats, HIST_WEIGHT * hist])
+        self.tree = BallTree(self.X, leaf_size=self.leaf_size)
+        print("similarity index:", changed, "districts updated,", len(names), "total")
+
+    def query(self, name, k=5):
+        """
+        Returns the `k` districts closest to `name` as (name, distance) pairs.
+        """
+        if self.tree is None or name not in self.pos:
+            return []
+
+        k = min(k + 1, len(self.names))
+        dist, idx = self.tree.query(self.X[self.pos[name]:self.pos[name] + 1], k=k)
+        return [
+            (self.names[i], float(dd))
+            for dd, i in zip(dist[0], idx[0])
+            if self.names[i] != name
+        ][:k - 1]
+
+    def query_all(self, k=5):
+        """
+        k nearest neighbours of every district in one batched tree query.
+
+        Returns a DataFrame with d_key, rank, neighbour and distance.
+        """
+        if self.tree is None:
+            return pd.DataFrame(columns=["d_key", "rank", "neighbour", "distance"])
+
+        k = min(k + 1, len(self.names))
+        dist, idx = self.tree.query(self.X, k=k)
+
+        rows = []
+        for a, (dd, ii) in enumerate(zip(dist, idx)):
+            rank = 0
+            for d, b in zip(dd, ii):
+                if b == a:
+                    continue
+                rank += 1
+                rows.append((self.names[a], rank, self.names[b], float(d)))
+        return pd.DataFrame(rows, columns=["d_key", "rank", "neighbour", "distance"])
+
+def file_stamp(path):
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+_index = None
+_stamp = None
+_lock = threading.Lock()
+
+def load_index(stats_path, hist_path=None, shp_path=None):
+    """
+    Shared index for the stats table, refreshed when any input changes.
+    Safe to call from several threads.
+
+    With `shp_path` the rows come from load_district_table, so keys match
+    the dashboard and API even for stats rows written without a state.
+    """
+    global _index, _stamp
+
+    with _lock:
+        stamp = (file_stamp(stats_path), file_stamp(hist_path), file_stamp(shp_path))
+        if _index is None:
+            _index = SimilarityIndex()
+
+        if stamp != _stamp and stamp[0] is not None:
+            if shp_path:
+                from data_loader import load_district_table
+                table = load_district_table(shp_path, stats_path)
+            else:
+                table = pd.read_csv(stats_path)
+            _index.update(table, load_table(hist_path) if hist_path else {})
+            _stamp = stamp
+
+        return _index
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--stats", type=str, default="src/district_stats.csv")
+    p.add_argument("--shapefile", type=str, default=None)
+    p.add_argument("--district", type=str, default=None, help="district key, e.g. \"Agra (Uttar Pradesh)\"")
+    p.add_argument("-k", type=int, default=5)
+    p.add_argument("--out", type=str, default=None, help="csv for all-pairs neighbours")
+
+    a = p.parse_args()
+
+    from histograms import hist_path_for
+    index = load_index(a.stats, hist_path_for(a.stats), a.shapefile)
+
+    if a.district:
+        for name, dist in index.query(a.district, a.k):
+            print(f"{name}: {dist:.3f}")
+    else:
+        df = index.query_all(a.k)
+        if a.out:
+            df.to_csv(a.out, index=False)
+            print("saved to", a.out)
+        else:
+            print(df)
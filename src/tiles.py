@@ -0,0 +1,320 @@
+import io
+import os
+import math
+import shutil
+import warnings
+import threading
+from urllib.parse import quote, unquote
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+
+WEB_MERCATOR = "EPSG:3857"
+ORIGIN = math.pi * 6378137.0
+TILE_SIZE = 256
+MAX_SCANS = 8        # scans whose layers stay registered, oldest used go first
+MAX_TILES = 512      # rendered tiles kept in memory per layer, the rest on disk
+
+# (colormap, vmin, vmax, hide zeros) per scan layer, same look as the thumbnails
+LAYER_STYLES = {
+    "ndvi": ("RdYlGn", -1, 1, False),
+    "ndbi": ("gray", -1, 1, False),
+    "sprawl": ("Reds", 0, 1, True),
+}
+
+def tile_bounds(z, x, y):
+    size = 2 * ORIGIN / 2 ** z
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+def downsample(arr):
+    # 2x2 block mean that ignores nan, odd edges are padded with nan
+    h, w = arr.shape
+    if h % 2 or w % 2:
+        pad = np.full((h + h % 2, w + w % 2), np.nan, dtype=arr.dtype)
+        pad[:h, :w] = arr
+        arr = pad
+        h, w = arr.shape
+
+    blocks = arr.reshape(h // 2, 2, w // 2, 2)
+    with warnings.catch_warnings():
+        # all-nan blocks stay nan
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3)).astype(arr.dtype)
+
+class TilePyramid:
+    """
+    Multi-resolution store of one index raster, served as XYZ PNG tiles.
+
+    The raster is warped to web mercator on the first tile request and each
+    overview level (2x coarser than the one below) is built the first time a
+    zoom needs it. Rendered tiles are cached per zoom level, in memory and
+    optionally on disk under `cache_dir`. Only the MAX_TILES most recently
+    used tiles stay in memory.
+    """
+
+    def __init__(self, arr, prof, style="ndvi", cache_dir=None):
+        self.src = np.asarray(arr, dtype="float32")
+        self.prof = prof
+        self.cmap, self.vmin, self.vmax, self.hide_zero = LAYER_STYLES[style]
+        self.cache_dir = cache_dir
+        self.levels = []
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _base(self):
+        from rasterio.warp import calculate_default_transform, reproject
+        from rasterio.transform import array_bounds
+        from rasterio.enums import Resampling
+
+        h, w = self.src.shape
+        trans = self.prof['transform']
+        left, bottom, right, top = array_bounds(h, w, trans)
+
+        dst_trans, dw, dh = calculate_default_transform(
+            self.prof['crs'], WEB_MERCATOR, w, h, left, bottom, right, top
+        )
+        dst = np.full((dh, dw), np.nan, dtype="float32")
+        reproject(
+            self.src,
+            dst,
+            src_transform=trans,
+            src_crs=self.prof['crs'],
+            src_nodata=np.nan,
+            dst_transform=dst_trans,
+            dst_crs=WEB_MERCATOR,
+            dst_nodata=np.nan,
+            resampling=Resampling.nearest,
+        )
+        return dst, dst_trans
+
+    def level(self, k):
+        with self.lock:
+            if not self.levels:
+                self.levels.append(self._base())
+
+            while len(self.levels) <= k:
+                arr, trans = self.levels[-1]
+                if max(arr.shape) <= TILE_SIZE:
+                    break
+                self.levels.append((downsample(arr), trans * trans.scale(2)))
+
+            return self.levels[min(k, len(self.levels) - 1)]
+
+    def bounds(self):
+        from rasterio.transform import array_bounds
+
+        arr, trans = self.level(0)
+        return array_bounds(arr.shape[0], arr.shape[1], trans)
+
+    def render(self, data):
+        norm = matplotlib.colors.Normalize(vmin=self.vmin, vmax=self.vmax)
+        rgba = plt.get_cmap(self.cmap)(norm(data))
+        hidden = np.isnan(data)
+        if self.hide_zero:
+            hidden |= data <= 0
+        rgba[hidden, 3] = 0
+
+        buf = io.BytesIO()
+        plt.imsave(buf, rgba, format="png")
+        return buf.getvalue()
+
+    def get_tile(self, z, x, y):
+        key = (z, x, y)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+        path = None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, str(z), str(x), f"{y}.png")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return self._keep(key, f.read())
+
+        left, bottom, right, top = tile_bounds(z, x, y)
+        dl, db, dr, dt = self.bounds()
+        if right <= dl or left >= dr or top <= db or bottom >= dt:
+            return self._keep(key, None)
+
+        from rasterio.warp import reproject
+        from rasterio.transform import from_bounds
+        from rasterio.enums import Resampling
+
+        # pick the coarsest overview that is still at least as fine as the tile
+        base_res = self.level(0)[1].a
+        tile_res = (right - left) / TILE_SIZE
+        k = max(0, int(math.floor(math.log2(tile_res / base_res))))
+        arr, trans = self.level(k)
+
+        out = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype="float32")
+        reproject(
+            arr,
+            out,
+            src_transform=trans,
+            src_crs=WEB_MERCATOR,
+            src_nodata=np.nan,
+            dst_transform=from_bounds(left, bottom, right, top, TILE_SIZE, TILE_SIZE),
+            dst_crs=WEB_MERCATOR,
+            dst_nodata=np.nan,
+            resampling=Resampling.nearest,
+        )
+
+        png = self.render(out)
+
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(png)
+
+        return self._keep(key, png)
+
+    def _keep(self, key, png):
+        with self.lock:
+            self.tiles[key] = png
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > MAX_TILES:
+                self.tiles.popitem(last=False)
+        return png
+
+# --- Tile Server ---
+LAYERS = {}
+SCANS = OrderedDict()   # scan id -> (layer ids, disk cache dirs), in LRU order
+_lock = threading.Lock()
+_server = None
+_public_url = None
+
+class TileHandler(BaseHTTPRequestHandler):
+    # GET /<layer id>/<z>/<x>/<y>.png
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 4 or not parts[3].endswith(".png"):
+            self.send_error(404)
+            return
+
+        layer_id = unquote(parts[0])
+        with _lock:
+            pyramid = LAYERS.get(layer_id)
+            scan_id = layer_id.rsplit("/", 1)[0]
+            if scan_id in SCANS:
+                SCANS.move_to_end(scan_id)
+        if pyramid is None:
+            self.send_error(404, "unknown layer")
+            return
+
+        try:
+            z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+            png = pyramid.get_tile(z, x, y)
+        except Exception as e:
+            print("tile error:", e)
+            self.send_error(500)
+            return
+
+        if png is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("Cache-Control", "max-age=3600")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, *args):
+        pass
+
+def start_tile_server(host="127.0.0.1", port=8765, public_url=None):
+    """
+    Starts the tile server in a daemon thread, once per process.
+
+    `public_url` is the base URL the browser uses to reach the server, e.g.
+    an HTTPS route on the app's domain that proxies to it (with the route
+    prefix stripped). Without it the
+    tiles are only reachable from the machine running the app.
+    """
+    global _server, _public_url
+    if _server is not None:
+        return _server
+
+    try:
+        _server = ThreadingHTTPServer((host, port), TileHandler)
+    except OSError:
+        print("port", port, "busy, using a free one")
+        _server = ThreadingHTTPServer((host, 0), TileHandler)
+
+    if public_url:
+        _public_url = public_url.rstrip("/")
+
+    t = threading.Thread(target=_server.serve_forever, daemon=True)
+    t.start()
+    print("tile server on", _server.server_address)
+    return _server
+
+def tile_url(layer_id):
+    if _public_url:
+        base = _public_url
+    else:
+        host, port = _server.server_address[:2]
+        base = f"http://{host}:{port}"
+    return f"{base}/{quote(layer_id, safe='')}/{{z}}/{{x}}/{{y}}.png"
+
+def drop_scan(scan_id):
+    # unregisters the layers of a scan and deletes its tiles on disk
+    with _lock:
+        layer_ids, dirs = SCANS.pop(scan_id, ([], []))
+        for layer_id in layer_ids:
+            LAYERS.pop(layer_id, None)
+
+    for d in dirs:
+        shutil.rmtree(d, ignore_errors=True)
+
+def prune_cache(cache_dir):
+    # removes tile folders left behind by scans that are no longer registered
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+
+    with _lock:
+        live = {os.path.basename(d) for _, dirs in SCANS.values() for d in dirs}
+
+    for name in os.listdir(cache_dir):
+        if name not in live:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+def register_scan(scan_id, ndvi, ndbi, slums, prof, cache_dir=None):
+    """
+    Registers the layers of one scan with the tile server.
+
+    Only the MAX_SCANS most recently used scans are kept, older ones are
+    dropped together with their disk cache. Returns a dict of layer
+    name -> XYZ url template for folium.
+    """
+    urls = {}
+    layer_ids = []
+    dirs = []
+    pyramids = {}
+    for name, arr in [("ndvi", ndvi), ("ndbi", ndbi), ("sprawl", slums)]:
+        layer_id = f"{scan_id}/{name}"
+        d = os.path.join(cache_dir, quote(layer_id, safe='')) if cache_dir else None
+        pyramids[layer_id] = TilePyramid(arr, prof, style=name, cache_dir=d)
+        layer_ids.append(layer_id)
+        if d:
+            dirs.append(d)
+        urls[name] = tile_url(layer_id)
+
+    with _lock:
+        LAYERS.update(pyramids)
+        SCANS[scan_id] = (layer_ids, dirs)
+        old = list(SCANS)[:-MAX_SCANS]
+
+    for scan in old:
+        drop_scan(scan)
+    prune_cache(cache_dir)
+
+    return urls